@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# Creates folders full of small synthetic Matroska files to benchmark batchmkvmerge with
+# The files have real EBML headers (Info, Tracks, Attachments, Chapters and a SeekHead)
+# but the Clusters are just filler bytes, so they can only be used with the stub MKVToolNix
+
+import os
+import sys
+import getopt as go
+
+# Track layout used when none is given: type:language:codec_id:default:name
+default_layout = 'video:und:V_MPEG4/ISO/AVC:1:,audio:jpn:A_AAC:1:,audio:eng:A_AAC:0:Commentary,' \
+                 'subtitles:eng:S_TEXT/ASS:1:Full,subtitles:eng:S_TEXT/UTF8:0:Signs'
+
+track_types = {'video': 1, 'audio': 2, 'subtitles': 17}
+
+
+def encode_id(e_id):
+    return e_id.to_bytes((e_id.bit_length() + 7) // 8, 'big')
+
+
+def encode_size(size):
+    # Always use 8 bytes, that way the SeekHead size doesn't depend on the positions it holds
+    return (0x01 << 56 | size).to_bytes(8, 'big')
+
+
+def element(e_id, payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    elif isinstance(payload, int):
+        payload = payload.to_bytes(max(1, (payload.bit_length() + 7) // 8), 'big')
+    elif isinstance(payload, list):
+        payload = b''.join(payload)
+    return encode_id(e_id) + encode_size(len(payload)) + payload
+
+
+def parse_layout(layout):
+    tracks = []
+    for t in layout.split(','):
+        t_type, lang, codec, default, name = (t.split(':', 4) + ['', '', '1', ''])[:5]
+        tracks.append({'type': t_type, 'language': lang or 'und', 'codec_id': codec,
+                       'default': default != '0', 'name': name})
+    return tracks
+
+
+def make_mkv(file_path, tracks, attachments=1, chapters=3, cluster_size=64 * 1024, title='Synthetic'):
+    header = element(0x1A45DFA3, [element(0x4282, 'matroska'), element(0x4287, 4), element(0x4285, 2)])
+    info = element(0x1549A966, [element(0x2AD7B1, 1000000), element(0x4D80, 'make_fixtures'),
+                                element(0x5741, 'make_fixtures')] + ([element(0x7BA9, title)] if title else []))
+
+    entries = []
+    for n, t in enumerate(tracks, 1):
+        children = [element(0xD7, n), element(0x73C5, n), element(0x83, track_types[t['type']]),
+                    element(0x86, t['codec_id']), element(0x22B59C, t['language']),
+                    element(0x88, 1 if t['default'] else 0)]
+        if t['name']:
+            children.append(element(0x536E, t['name']))
+        entries.append(element(0xAE, children))
+    track_el = element(0x1654AE6B, entries)
+
+    att_el = b''
+    if attachments:
+        att_el = element(0x1941A469, [element(0x61A7, [element(0x466E, 'font' + str(a) + '.ttf'),
+                                                       element(0x4660, 'application/x-truetype-font'),
+                                                       element(0x465C, b'\0' * 256),
+                                                       element(0x46AE, a + 1)]) for a in range(attachments)])
+    chapt_el = b''
+    if chapters:
+        chapt_el = element(0x1043A770, [element(0x45B9, [element(0xB6, [element(0x73C4, c + 1),
+                                                                        element(0x91, c * 1000000000)])
+                                                         for c in range(chapters)])])
+    # Statistics tags like MKVMerge writes them, the whole Cluster is split evenly between the tracks
+    tags_el = element(0x1254C367, [element(0x7373, [element(0x63C0, [element(0x63C5, n)]),
+                                                    element(0x67C8, [element(0x45A3, 'NUMBER_OF_BYTES'),
+                                                                     element(0x4487, str(cluster_size // len(tracks)))])])
+                                   for n in range(1, len(tracks) + 1)]) if tracks else b''
+    cluster = element(0x1F43B675, [element(0xE7, 0), element(0xA3, b'\0' * max(cluster_size - 32, 0))])
+
+    # Attachments, Chapters and Tags go after the Cluster, like MKVMerge does, so they can only be found through the SeekHead
+    body = [info, track_el, cluster, att_el, chapt_el, tags_el]
+    seek_ids = [0x1549A966, 0x1654AE6B, None, 0x1941A469, 0x1043A770, 0x1254C367]
+
+    def seek_head(positions):
+        return element(0x114D9B74, [element(0x4DBB, [element(0x53AB, encode_id(i)),
+                                                     element(0x53AC, pos.to_bytes(8, 'big'))])
+                                    for i, pos in positions])
+
+    placeholder = [(i, 0) for i, b in zip(seek_ids, body) if i is not None and b]
+    pos = len(seek_head(placeholder))
+    positions = []
+    for i, b in zip(seek_ids, body):
+        if i is not None and b:
+            positions.append((i, pos))
+        pos += len(b)
+
+    segment = element(0x18538067, [seek_head(positions)] + body)
+    with open(file_path, 'wb') as f:
+        f.write(header + segment)
+
+
+def make_tree(out_path, files, per_folder=100, layout=default_layout, attachments=1, chapters=3,
+              cluster_size=64 * 1024):
+    # Spreads the files over folders of per_folder files each, like a library of seasons
+    tracks = parse_layout(layout)
+    made = []
+    for n in range(files):
+        folder = os.path.join(out_path, 'Show ' + str(n // per_folder).zfill(4))
+        os.makedirs(folder, exist_ok=True)
+        file_path = os.path.join(folder, 'Episode ' + str(n % per_folder).zfill(4) + '.mkv')
+        make_mkv(file_path, tracks, attachments, chapters, cluster_size)
+        made.append(file_path)
+    return made
+
+
+def main(argvs):
+    usage = '''Usage: make_fixtures.py -o OUT_DIR [OPTIONS]...
+
+-o, --out-path       Folder to create the files in
+-n, --files          Number of files (Default: 100)
+--per-folder         Number of files per folder (Default: 100)
+--layout             Tracks as type:language:codec_id:default:name, separated by a comma
+--attachments        Number of attachments per file (Default: 1)
+--chapters           Number of chapters per file (Default: 3)
+--cluster-size       Bytes of filler data per file (Default: 65536)'''
+    try:
+        opts, _ = go.getopt(argvs, 'ho:n:', ['help', 'out-path=', 'files=', 'per-folder=', 'layout=',
+                                             'attachments=', 'chapters=', 'cluster-size='])
+    except go.GetoptError as error:
+        sys.exit(str(error) + '\n' + usage)
+
+    options = {'files': 100, 'per_folder': 100, 'layout': default_layout, 'attachments': 1, 'chapters': 3,
+               'cluster_size': 64 * 1024}
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print(usage)
+            sys.exit()
+        key = {'-o': 'out_path', '-n': 'files'}.get(opt, opt.lstrip('-').replace('-', '_'))
+        options[key] = arg if key in ('out_path', 'layout') else int(arg)
+
+    if 'out_path' not in options:
+        sys.exit(usage)
+    make_tree(**options)
+    print('Created ' + str(options['files']) + ' file(s) in "' + options['out_path'] + '"')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# Times the batch path of batchmkvmerge on synthetic libraries of different sizes
+# MKVToolNix isn't needed, the stub from stub_mkvtoolnix.py is put in front of PATH
+#
+# Scenarios:
+#   discovery       discover_files() over the whole tree
+#   probe-native    get_mkv_info() with the built-in Matroska reader
+#   probe-mkvmerge  get_mkv_info() through (stub) MKVMerge processes
+#   plan            create_command() for every file
+#   batch-serial    the whole script with -j 1
+#   batch-parallel  the whole script with -j N
+
+import os
+import sys
+import json
+import time
+import shutil
+import getopt as go
+import tempfile
+import contextlib
+import subprocess as sp
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, bench_dir)
+import batchmkvmerge as bm  # noqa: E402
+import make_fixtures  # noqa: E402
+
+all_scenarios = ['discovery', 'probe-native', 'probe-mkvmerge', 'plan', 'batch-serial', 'batch-parallel']
+
+
+def make_stub_bin(tmp_dir):
+    # Links the stub under the names of the real tools
+    bin_dir = os.path.join(tmp_dir, 'bin')
+    os.makedirs(bin_dir)
+    for tool in ('mkvmerge', 'mkvextract', 'mkvpropedit'):
+        os.symlink(os.path.join(bench_dir, 'stub_mkvtoolnix.py'), os.path.join(bin_dir, tool))
+    return bin_dir
+
+
+def set_options(tree, out_path, extra=()):
+    # Makes the options the active ones, without running the batch
+    bm.Remuxer(bm.get_user_input(['-i', tree, '-o', out_path, '--sub-folders', '--no-cache',
+                                  '--no-resume'] + list(extra))).start()
+
+
+def timed(func):
+    # The script prints a lot for every file, which would mostly measure the terminal
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        result = func()
+        return time.perf_counter() - started, result
+
+
+def run_discovery(tree, out_path, files):
+    set_options(tree, out_path)
+    return timed(lambda: len(list(bm.discover_files())))
+
+
+def run_probe(tree, out_path, files, native=True):
+    set_options(tree, out_path, [] if native else ['--no-native-probe'])
+    return timed(lambda: [bm.get_mkv_info(os.path.dirname(f) + '/', os.path.basename(f)) for f in files])
+
+
+def run_plan(tree, out_path, files):
+    set_options(tree, out_path, ['-a', 'jpn', '-s', 'eng', '--no-dupe'])
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        infos = [(f, bm.get_mkv_info(os.path.dirname(f) + '/', os.path.basename(f))) for f in files]
+    return timed(lambda: [bm.create_command(os.path.basename(f), info, os.path.dirname(f)) for f, info in infos])
+
+
+def run_batch(tree, out_path, files, jobs, bin_dir, latency):
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''), STUB_LATENCY=str(latency),
+               STUB_OUTPUT='empty', XDG_CACHE_HOME=os.path.join(out_path, 'cache'))
+    cmd = [sys.executable, os.path.join(repo_dir, 'batchmkvmerge.py'), '-i', tree, '-o', out_path,
+           '--sub-folders', '--no-cache', '--no-resume', '--nc', '-j', str(jobs)]
+    started = time.perf_counter()
+    result = sp.run(cmd, env=env, stdout=sp.DEVNULL, stderr=sp.PIPE, universal_newlines=True)
+    seconds = time.perf_counter() - started
+    if result.returncode != 0:
+        sys.exit('Batch run failed:\n' + result.stderr)
+    return seconds, None
+
+
+def main(argvs):
+    usage = '''Usage: run_benchmarks.py [OPTIONS]...
+
+-n, --sizes          Library sizes to test (Default: 100,1000,10000)
+-s, --scenarios      Scenarios to run (Default: all of them)
+                     ''' + ', '.join(all_scenarios) + '''
+-j, --jobs           Jobs used for batch-parallel (Default: number of CPUs)
+--latency            Seconds every stub remux takes (Default: 0.01)
+--spawn-max          Largest size to run probe-mkvmerge, batch-serial and batch-parallel with (Default: 1000)
+--json               Also write the results to this file'''
+    try:
+        opts, _ = go.getopt(argvs, 'hn:s:j:', ['help', 'sizes=', 'scenarios=', 'jobs=', 'latency=', 'spawn-max=',
+                                               'json='])
+    except go.GetoptError as error:
+        sys.exit(str(error) + '\n' + usage)
+
+    sizes, scenarios = [100, 1000, 10000], all_scenarios
+    jobs, latency, spawn_max, json_path = os.cpu_count() or 1, 0.01, 1000, None
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print(usage)
+            sys.exit()
+        elif opt in ('-n', '--sizes'):
+            sizes = [int(n) for n in arg.split(',')]
+        elif opt in ('-s', '--scenarios'):
+            scenarios = arg.split(',')
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+        elif opt == '--latency':
+            latency = float(arg)
+        elif opt == '--spawn-max':
+            spawn_max = int(arg)
+        elif opt == '--json':
+            json_path = arg
+
+    results = []
+    tmp_dir = tempfile.mkdtemp(prefix='batchmkvmerge-bench-')
+    old_path = os.environ.get('PATH', '')
+    try:
+        bin_dir = make_stub_bin(tmp_dir)
+        os.environ['PATH'] = bin_dir + os.pathsep + old_path
+        print('size'.rjust(7) + '  ' + 'scenario'.ljust(16) + 'seconds'.rjust(10) + 'files/s'.rjust(12))
+        for size in sizes:
+            tree = os.path.join(tmp_dir, 'lib-' + str(size))
+            files = make_fixtures.make_tree(tree, size, cluster_size=4096)
+            for scenario in scenarios:
+                spawns = scenario in ('probe-mkvmerge', 'batch-serial', 'batch-parallel')
+                if spawns and size > spawn_max:
+                    print(str(size).rjust(7) + '  ' + scenario.ljust(16) + '  skipped (--spawn-max ' +
+                          str(spawn_max) + ')')
+                    continue
+                out_path = tempfile.mkdtemp(prefix='out-', dir=tmp_dir)
+                if scenario == 'discovery':
+                    seconds, _ = run_discovery(tree, out_path, files)
+                elif scenario == 'probe-native':
+                    seconds, _ = run_probe(tree, out_path, files)
+                elif scenario == 'probe-mkvmerge':
+                    seconds, _ = run_probe(tree, out_path, files, native=False)
+                elif scenario == 'plan':
+                    seconds, _ = run_plan(tree, out_path, files)
+                elif scenario == 'batch-serial':
+                    seconds, _ = run_batch(tree, out_path, files, 1, bin_dir, latency)
+                elif scenario == 'batch-parallel':
+                    seconds, _ = run_batch(tree, out_path, files, jobs, bin_dir, latency)
+                else:
+                    sys.exit('Unknown scenario "' + scenario + '"')
+                shutil.rmtree(out_path)
+
+                rate = size / seconds if seconds else 0
+                results.append({'size': size, 'scenario': scenario, 'seconds': round(seconds, 4),
+                                'files_per_s': round(rate, 1)})
+                print(str(size).rjust(7) + '  ' + scenario.ljust(16) + ('%.3f' % seconds).rjust(10) +
+                      ('%.1f' % rate).rjust(12))
+    finally:
+        os.environ['PATH'] = old_path
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({'jobs': jobs, 'latency': latency, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# Stand-in for mkvmerge, mkvextract and mkvpropedit, so the batch path can be benchmarked without MKVToolNix
+# The tool it acts as is taken from the name it's started with, run_benchmarks.py links it under all three names
+#
+# Environment variables:
+#   STUB_LATENCY         Seconds every remux/extract call takes (Default: 0)
+#   STUB_PROGRESS_STEPS  Number of progress lines printed during that time (Default: 4)
+#   STUB_OUTPUT          'copy' to copy the source to the output, 'empty' to create an empty file (Default: copy)
+#   STUB_FAIL            Pattern of source file names which make the call fail (Example: *E0003*)
+
+import os
+import sys
+import json
+import time
+import shutil
+import fnmatch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import batchmkvmerge  # noqa: E402
+
+
+def progress(gui_mode, source):
+    # Like the real tools the whole source is read, a part for every progress step
+    steps = max(int(os.environ.get('STUB_PROGRESS_STEPS', '4')), 1)
+    latency = float(os.environ.get('STUB_LATENCY', '0'))
+    part_size = os.path.getsize(source) // steps + 1
+    f = open(source, 'rb')
+    for step in range(1, steps + 1):
+        time.sleep(latency / steps)
+        while f.tell() < part_size * step and f.read(1024 * 1024):
+            pass
+        perc = str(step * 100 // steps) + '%'
+        print('#GUI#progress ' + perc if gui_mode else 'Progress: ' + perc, flush=True)
+    f.close()
+
+
+def should_fail(source, gui_mode):
+    pattern = os.environ.get('STUB_FAIL')
+    if pattern and fnmatch.fnmatch(os.path.basename(source), pattern):
+        print(('#GUI#error ' if gui_mode else 'Error: ') + 'stub failure for "' + source + '"', flush=True)
+        return True
+    return False
+
+
+def write_output(source, out_file):
+    os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+    if os.environ.get('STUB_OUTPUT', 'copy') == 'copy':
+        shutil.copyfile(source, out_file)
+    else:
+        open(out_file, 'wb').close()
+
+
+def mkvmerge(args):
+    if '--version' in args or '-V' in args:
+        print('mkvmerge v0.0.0 (\'stub\') 64-bit')
+        return 0
+
+    if '-i' in args or '-J' in args or '--identify' in args:
+        source = args[-1]
+        try:
+            json_out = batchmkvmerge.read_mkv_headers(source)
+        except (OSError, ValueError, IndexError) as error:
+            # What MKVMerge prints for a file it doesn't recognize, without any track info
+            print(json.dumps({'container': {'recognized': False, 'supported': False},
+                              'errors': ['The type of file \'' + source + '\' could not be recognized. (' +
+                                         str(error) + ')'],
+                              'file_name': source, 'identification_format_version': 12, 'warnings': []}))
+            return 2
+        json_out['file_name'] = source
+        json_out['container'].update({'recognized': True, 'supported': True, 'type': 'Matroska'})
+        print(json.dumps(json_out))
+        return 0
+
+    gui_mode = '--gui-mode' in args
+    out_file, source = args[args.index('-o') + 1], args[-1]
+    if should_fail(source, gui_mode):
+        return 2
+    progress(gui_mode, source)
+    write_output(source, out_file)
+    return 0
+
+
+def mkvextract(args):
+    gui_mode = '--gui-mode' in args
+    args = [a for a in args if a != '--gui-mode']
+    # Both 'mkvextract tracks SOURCE ...' and 'mkvextract SOURCE tracks ...' are used
+    modes = ('tracks', 'attachments', 'chapters', 'tags', 'timestamps_v2', 'cues', 'cuesheet')
+    source = args[1] if args[0] in modes else args[0]
+    if should_fail(source, gui_mode):
+        return 2
+    progress(gui_mode, source)
+    for a in args:
+        if a in modes or a.startswith('-') or a == source:
+            continue
+        out_file = a.split(':', 1)[1] if ':' in a and a.split(':', 1)[0].isdigit() else a
+        os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+        open(out_file, 'wb').close()
+    return 0
+
+
+def mkvpropedit(args):
+    return 0
+
+
+if __name__ == '__main__':
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    tools = {'mkvmerge': mkvmerge, 'mkvextract': mkvextract, 'mkvpropedit': mkvpropedit}
+    if tool not in tools:
+        sys.exit('Start this script as mkvmerge, mkvextract or mkvpropedit')
+    sys.exit(tools[tool](sys.argv[1:]))